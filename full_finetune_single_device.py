@@ -935,6 +935,7 @@ class FullFinetuneRecipeSingleDevice(FTRecipeInterface):
                     if self._lr_scheduler is not None:
                         self._lr_scheduler.step()
                     self.global_step += 1
+                    self._model.on_optimizer_step()
 
                     # Post-unfreeze LR re-warmup for Qwen params (param_group[1]).
                     # After the cosine scheduler sets the LR, we scale the Qwen group's
@@ -76,6 +76,11 @@ class InferenceRecipe:
         )
         self._tokenizer = config.instantiate(cfg.tokenizer)
 
+        if cfg.get("quantize_local_encoder", False):
+            self._model.eval()
+            self._model.quantize_local_encoder()
+            logger.info("Local encoder quantized to int8 weight-only.")
+
     def _setup_model(
         self,
         model_cfg: DictConfig,
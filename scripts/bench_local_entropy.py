@@ -0,0 +1,62 @@
+"""Benchmark the compute_local_entropy backends.
+
+The triton kernel runs one program per batch row, so at small batch sizes it
+may lose to the vectorized torch path. Run this on the target GPU before
+switching dynamic patching over to backend="triton".
+
+Usage:
+    conda run -n qwen python scripts/bench_local_entropy.py \
+        [--batch_sizes 1 8] [--seq_len 4096] [--window_size 8]
+"""
+
+import argparse
+import time
+
+import torch
+
+from ttblt.bltqwen import HAS_NUMBA, HAS_TRITON, compute_local_entropy
+
+
+def bench(fn, iters, sync):
+    for _ in range(3):  # warm up compile / jit caches
+        fn()
+    sync()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    sync()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark local entropy backends")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--seq_len", type=int, default=4096)
+    parser.add_argument("--window_size", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+    for device in devices:
+        backends = ["torch"]
+        if device == "cpu" and HAS_NUMBA:
+            backends.append("numba")
+        if device == "cuda" and HAS_TRITON:
+            backends.append("triton")
+        sync = torch.cuda.synchronize if device == "cuda" else (lambda: None)
+
+        for batch_size in args.batch_sizes:
+            tokens = torch.randint(0, 256, (batch_size, args.seq_len), device=device)
+            ref = compute_local_entropy(tokens, window_size=args.window_size, backend="torch")
+            for backend in backends:
+                fn = lambda: compute_local_entropy(tokens, window_size=args.window_size, backend=backend)
+                max_diff = (fn().float() - ref.float()).abs().max().item()
+                ms = bench(fn, args.iters, sync)
+                print(
+                    f"{device:4s} B={batch_size:<3d} S={args.seq_len} {backend:6s} "
+                    f"{ms:8.3f} ms  max diff vs torch {max_diff:.2e}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
+import importlib.util
+import itertools
 import math
 import os
 
+import numpy as np
 import torch
 from torch import nn
+import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
 from torchtune.modules.transformer import TransformerDecoder
@@ -15,6 +20,11 @@ from torchtune.modules import (
 from torchtune.modules.model_fusion import FusionLayer
 from torchtune.models.qwen2._component_builders import qwen2_mlp
 
+# Optional local entropy backends. Checked without importing them: the kernels
+# live in ttblt.entropy_kernels, which is only imported when they're used.
+HAS_TRITON = importlib.util.find_spec("triton") is not None
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
 PAD_ID = 256
 BOS_ID = 257
 EOS_ID = 258
@@ -85,9 +95,12 @@ class HashNGramEmbedder(nn.Module):
             powers = torch.tensor(powers_list, dtype=torch.int32)
             self.register_buffer(f'powers_{n}', powers)
 
-    def forward(self, tokens: torch.LongTensor) -> torch.Tensor:
+    def forward(self, tokens: torch.LongTensor, input_pos: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         tokens: [batch_size, seq_len] of byte IDs in [0..255].
+        input_pos: optional [batch_size, seq_len] position of each byte within its
+            packed document. n-grams that would reach back into the previous
+            document get bucket 0, the same as the first n - 1 bytes of a sequence.
         Returns final embeddings of shape [batch_size, seq_len, embed_dim].
         All hash arithmetic is done in int32.
         """
@@ -114,6 +127,8 @@ class HashNGramEmbedder(nn.Module):
             hashed_idxs = torch.zeros((bsz, seq_len), dtype=torch.int32, device=tokens.device)
             hashed_idxs[:, n - 1:] = hashed_vals
             hashed_idxs = hashed_idxs % self.num_buckets
+            if input_pos is not None:
+                hashed_idxs = hashed_idxs.masked_fill(input_pos < n - 1, 0)
 
             if self.shared_table:
                 ngram_embed = self.shared_ngram_table(hashed_idxs.long())  # [bsz, seq_len, embed_dim]
@@ -225,7 +240,11 @@ class LocalDecoder(nn.Module):
         self.output = nn.Linear(embed_dim, vocab_size, bias=False)
         self.to(dtype=dtype)
 
-    def forward(self, byte_embeds, patch_embs, patch_ids):
+    def forward(self, byte_embeds, patch_embs, patch_ids, mask=None, patch_doc_ids=None):
+        """
+        mask: optional byte-level self-attention mask (e.g. block causal for packing)
+        patch_doc_ids: optional [batch_size, num_patches] packed document index per patch
+        """
         x = byte_embeds
         x = x.to(patch_embs.dtype)  # Match dtype of incoming patch embeddings
 
@@ -239,11 +258,17 @@ class LocalDecoder(nn.Module):
         cross_mask = (
             shifted_patch_ids.unsqueeze(2) == torch.arange(num_patches, device=x.device).unsqueeze(0).unsqueeze(0)
         )  # Shape: [batch_size, seq_len, num_patches]
+        if patch_doc_ids is not None:
+            # Packed sequences: the first patch of a document must not see the
+            # last patch of the previous document. Patches never span documents,
+            # so each byte's document is its patch's document.
+            doc_ids = patch_doc_ids.gather(1, patch_ids)
+            cross_mask = cross_mask & (doc_ids.unsqueeze(2) == patch_doc_ids.unsqueeze(1))
 
         # Run interleaved self-attention and cross-attention layers
         for layer, ltype in zip(self.layers, self.layer_types):
             if ltype == 'self':
-                x = layer(x)
+                x = layer(x, mask=mask)
             else:
                 x = layer(x, encoder_input=patch_embs, encoder_mask=cross_mask)
             x = self.dropout(x)
@@ -254,6 +279,26 @@ class LocalDecoder(nn.Module):
         logits = self.output(x)  # Shape: [batch_size, seq_len, vocab_size]
         return logits
 
+class HiddenStateDecoder(TransformerDecoder):
+    """TransformerDecoder that returns the final normed hidden state.
+
+    The stock unembed calls .float() on the output, which with an Identity
+    output is just a bf16 -> fp32 -> bf16 round trip for the caller.
+    """
+    def unembed(self, h):
+        return self.norm(h)
+
+    def forward(self, tokens, *, mask=None, input_pos=None):
+        # Packed positions only matter to the hash n-gram embedder. The local
+        # layers have no RoPE and no KV cache, so input_pos stops there.
+        if input_pos is not None and isinstance(self.tok_embeddings, HashNGramEmbedder):
+            h = self.tok_embeddings(tokens, input_pos=input_pos)
+        else:
+            h = self.tok_embeddings(tokens)
+        for layer in self.layers:
+            h = layer(h, mask=mask)
+        return self.unembed(h)
+
 class LocalEncoderWithPooling(nn.Module):
     def __init__(self, base_encoder, cross_attn_layers, embed_dim, global_dim, dropout=0.0):
         super().__init__()
@@ -262,18 +307,16 @@ class LocalEncoderWithPooling(nn.Module):
         self.patch_projector = PatchToGlobalProjector(embed_dim, global_dim)
         self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
 
-    def forward(self, bytes, patch_ids):
+    def forward(self, bytes, patch_ids, num_patches, mask=None, input_pos=None):
         # Get byte-level embeddings from the base encoder
-        byte_embeds = self.base_encoder(bytes, mask=None)
-        byte_embeds = byte_embeds.to(torch.bfloat16)
+        byte_embeds = self.base_encoder(bytes, mask=mask, input_pos=input_pos)
         byte_embeds = self.dropout(byte_embeds)
 
         # Create initial patch representations via mean pooling
-        patch_embs, patch_mask = patch_reduce(byte_embeds, patch_ids, reduce_op="mean")
+        patch_embs, patch_mask = patch_reduce(byte_embeds, patch_ids, num_patches, reduce_op="mean")
 
         # Apply cross-attention: patches (query) attend to bytes (key/value)
         if self.cross_attn_layers:
-            num_patches = patch_embs.size(1)
             # mask: [batch, num_patches, seq_len] — each patch attends to its constituent bytes
             patch_to_byte_mask = (
                 patch_ids.unsqueeze(1) == torch.arange(num_patches, device=byte_embeds.device).unsqueeze(0).unsqueeze(2)
@@ -343,7 +386,7 @@ def build_local_encoder(
         )
         layers.append(layer)
 
-    base_encoder = TransformerDecoder(
+    base_encoder = HiddenStateDecoder(
         tok_embeddings=tok_embeddings,
         layers=layers,
         max_seq_len=max_seq_len,
@@ -385,136 +428,200 @@ def build_local_encoder(
 # dynamic patching
 ################################################
 
-def compute_local_entropy(bytes_tensor, window_size=8):
+def sliding_byte_counts(bytes_tensor, window_size=8):
+    """Count each byte value over a trailing window, for every position at once.
+
+    Arguments:
+        bytes_tensor: Torch.tensor[batch_size, seq_len] byte ids
+        window_size: int size to window across
+
+        freq: torch.Tensor[batch_size, seq_len, VOCAB_SIZE] counts; uint8 when
+            window_size < 255, wider otherwise
+    """
+    # Running count of each byte value via cumsum over the one-hot bytes, minus
+    # the running count from window_size + 1 positions back, so position pos
+    # sees bytes [pos - window_size, pos].
+    freq = F.one_hot(bytes_tensor, VOCAB_SIZE).cumsum(dim=1)  # [batch_size, seq_len, VOCAB_SIZE]
+    span = window_size + 1
+    if span < freq.size(1):
+        freq[:, span:] -= freq[:, :-span].clone()
+    # Counts never exceed window_size + 1: use the narrowest dtype that holds that
+    if window_size + 1 <= torch.iinfo(torch.uint8).max:
+        return freq.to(torch.uint8)
+    if window_size + 1 <= torch.iinfo(torch.int16).max:
+        return freq.to(torch.int16)
+    return freq.to(torch.int32)
+
+def compute_local_entropy(bytes_tensor, window_size=8, freq=None, backend="auto"):
     """Return a per-token "entropy" measure to guide patching
     
     Arguments:
         bytes_tensor: Torch.tensor[batch_size, seq_len] byttes to calc entropy on
         window_size: int size to window across
+        freq: optional precomputed sliding_byte_counts(bytes_tensor, window_size).
+            Must use the same window_size, or counts overrun the entropy table.
+        backend: "auto", "torch", "numba" or "triton". "auto" uses numba on CPU
+            when installed and torch otherwise. The triton kernel is opt-in until
+            scripts/bench_local_entropy.py shows it winning on the target GPU.
 
         local_entropy: torch.Tensor[batch_size, seq_len]
     """
-    # bytes_tensor: 
-    device = bytes_tensor.device
+    if freq is not None:
+        assert freq.shape == (*bytes_tensor.shape, VOCAB_SIZE), (
+            f"freq shape {tuple(freq.shape)} does not match bytes {tuple(bytes_tensor.shape)}"
+        )
+    if backend == "auto":
+        use_numba = freq is None and bytes_tensor.device.type == "cpu" and HAS_NUMBA
+        backend = "numba" if use_numba else "torch"
+    if backend == "triton":
+        assert freq is None and HAS_TRITON, "triton backend needs triton and no precomputed freq"
+        return _local_entropy_triton(bytes_tensor, window_size=window_size)
+    if backend == "numba":
+        assert freq is None and bytes_tensor.device.type == "cpu" and HAS_NUMBA, "numba backend needs numba and a CPU tensor"
+        return _local_entropy_cpu(bytes_tensor, window_size=window_size)
+    assert backend == "torch", f"Unknown local entropy backend: {backend}"
+    return _local_entropy_vectorized(bytes_tensor, window_size=window_size, freq=freq)
+
+@torch.compile(dynamic=True, fullgraph=True)
+def _local_entropy_vectorized(bytes_tensor, window_size=8, freq=None):
+    if freq is None:
+        freq = sliding_byte_counts(bytes_tensor, window_size=window_size)
+    freq = freq.to(device=bytes_tensor.device, dtype=torch.long)
+
+    # The window at pos holds exactly min(pos + 1, window_size + 1) bytes, so
+    # every -p*log2(p) term is one of a few (window, count) pairs: gather them
+    # from a table rather than computing log2 over the whole count tensor.
+    seq_len = bytes_tensor.size(1)
+    denom = torch.arange(1, seq_len + 1, device=bytes_tensor.device).clamp(max=window_size + 1)
+    entr_lut = _entropy_lut(window_size, device=bytes_tensor.device).to(torch.float32)
+    local_entropy = entr_lut[denom.view(1, seq_len, 1), freq].sum(dim=-1)
+    return local_entropy
+
+def _entropy_lut(window_size, device=None):
+    """[window_size + 2, window_size + 2] table of -p*log2(p) for p = count / window.
+
+    Indexed [window, count]; entr is exactly 0 at count 0.
+    """
+    counts = torch.arange(window_size + 2, dtype=torch.float64, device=device)
+    p = counts.unsqueeze(0) / counts.clamp_min(1).unsqueeze(1)
+    return torch.special.entr(p) * (1.0 / math.log(2))
+
+def _local_entropy_triton(bytes_tensor, window_size=8):
+    import triton
+    from ttblt.entropy_kernels import local_entropy_kernel
+
     batch_size, seq_len = bytes_tensor.shape
-    
-    # We’ll keep a sliding frequency table. Initialize all zeros:
-    freq = torch.zeros(batch_size, VOCAB_SIZE, device=device)
-    local_entropy = torch.zeros(batch_size, seq_len, device=device)
-    
-    for pos in range(seq_len):
-        # add current byte
-        current_byte = bytes_tensor[:, pos]
-        freq[torch.arange(batch_size), current_byte] += 1
-        
-        # compute distribution
-        dist = freq / freq.sum(dim=1, keepdim=True).clamp_min(1e-8)
-        # compute -p*log2(p)
-        ent = -(dist * (dist + 1e-8).log2()).sum(dim=1)
-        local_entropy[:, pos] = ent
-        
-        # remove oldest byte if we exceed window size
-        if pos >= window_size:
-            oldest_byte = bytes_tensor[:, pos - window_size]
-            freq[torch.arange(batch_size), oldest_byte] -= 1
+    bytes_tensor = bytes_tensor.contiguous()
+    local_entropy = torch.empty(batch_size, seq_len, device=bytes_tensor.device, dtype=torch.float32)
+    local_entropy_kernel[(batch_size,)](
+        bytes_tensor, local_entropy, seq_len, window_size, bytes_tensor.stride(0),
+        BLOCK=triton.next_power_of_2(VOCAB_SIZE),
+    )
     return local_entropy
 
+def _local_entropy_cpu(bytes_tensor, window_size=8):
+    from ttblt.entropy_kernels import local_entropy_numba
+
+    entr_lut = _entropy_lut(window_size).numpy()
+    byte_ids = np.ascontiguousarray(bytes_tensor.numpy())
+    return torch.from_numpy(local_entropy_numba(byte_ids, window_size, entr_lut))
+
 def dynamic_patch(
     bytes_tensor: torch.Tensor,
-    threshold: float = 3.0,   # starting entropy threshold in bits
-    min_threshold: float = 2.0,    # lower bound
-    max_threshold: float = 5.0,    # upper bound
-    threshold_step_down: float = 0.1,  # how much to decrease threshold if no patches triggered
-    threshold_step_up: float = 0.1,    # how much to increase threshold if we trigger a patch
+    threshold: float = 3.0,   # entropy threshold in bits
     patch_size: int = 4,
-    window_size: int = 8
+    window_size: int = 8,
+    freq: Optional[torch.Tensor] = None,
+    input_pos: Optional[torch.Tensor] = None,
 ):
     """
-    A dynamic patching approach that adjusts the entropy threshold
-    upward/downward depending on whether patches are being triggered too often or not enough.
+    A dynamic patching approach: start a new patch wherever the local entropy
+    exceeds the threshold, or once the current patch reaches patch_size bytes.
+
+    All boundaries are found in one vectorized pass, so the threshold is fixed
+    for the whole sequence rather than adapted position by position.
 
     Args:
         bytes_tensor: [batch_size, seq_len]
-        threshold: initial bits threshold for local entropy
-        min_threshold, max_threshold: clamp thresholds
-        threshold_step_down, threshold_step_up: step sizes
+        threshold: bits threshold for local entropy
         patch_size: max patch length if we haven't triggered a boundary earlier
         window_size: for computing local entropy
+        freq: optional precomputed sliding_byte_counts with the same window_size
+        input_pos: optional [batch_size, seq_len] position of each byte within its
+            packed document. Documents always start a new patch, but the entropy
+            window is not reset, so the first window_size bytes of a document
+            still count bytes from the previous one and can move its boundaries.
 
     Returns:
         patch_ids: [batch_size, seq_len] with patch ID for each token
         local_ent: [batch_size, seq_len] local entropy in bits
     """
-    local_ent = compute_local_entropy(bytes_tensor, window_size=window_size)
-    batch_size, seq_len = bytes_tensor.shape
-    
-    # Each row’s patch assignment
-    patch_ids = torch.zeros(batch_size, seq_len, dtype=torch.long, device=bytes_tensor.device)
-
-    current_patch = torch.zeros(batch_size, dtype=torch.long, device=bytes_tensor.device)
-    patch_lengths = torch.zeros(batch_size, dtype=torch.long, device=bytes_tensor.device)
-
-    # Keep track of how many consecutive tokens we have processed w/o triggering any new patch
-    # so we can adjust threshold if we go too long
-    consecutive_no_trigger = 0
-    
-    for pos in range(seq_len):
-        patch_lengths += 1
-        
-        # Which batch elements exceed threshold or hit patch size
-        trigger_new_patch = (local_ent[:, pos] > threshold) | (patch_lengths >= patch_size)
-        triggered_rows = trigger_new_patch.nonzero(as_tuple=False).flatten()
-
-        if len(triggered_rows) > 0:
-            # For each row that triggered, increment patch and reset patch_lengths
-            current_patch[triggered_rows] += 1
-            patch_lengths[triggered_rows] = 0
-
-            # Because at least 1 row triggered a patch, we can optionally adjust threshold upward
-            # or downward. For example, *raising* threshold if we keep splitting too often:
-            threshold = min(threshold + threshold_step_up, max_threshold)
-            
-            consecutive_no_trigger = 0
-        else:
-            # No new patch was triggered
-            consecutive_no_trigger += 1
-            # If we haven't triggered for a while, lower threshold so that we become more likely
-            # to split in the future.
-            threshold = max(threshold - threshold_step_down, min_threshold)
-
-        patch_ids[:, pos] = current_patch
-
+    local_ent = compute_local_entropy(bytes_tensor, window_size=window_size, freq=freq)
+    patch_ids = _entropy_patch_ids(local_ent, threshold, patch_size, input_pos)
     return patch_ids, local_ent
 
-def patch_reduce(h, patch_ids, reduce_op="mean"):
+@torch.compile(dynamic=True, fullgraph=True)
+def _entropy_patch_ids(local_ent, threshold, patch_size, input_pos=None):
+    batch_size, seq_len = local_ent.shape
+
+    # A byte starts a new patch if it is high entropy, or if it is patch_size
+    # bytes past the last entropy boundary (which caps every patch at
+    # patch_size bytes). The last entropy boundary at each position is a
+    # running max of trigger positions. With packed input the count also
+    # restarts at each document, so position 0 of every document is a
+    # boundary too.
+    trig_ent = local_ent > threshold
+    pos = torch.arange(seq_len, device=local_ent.device).unsqueeze(0)
+    start = torch.where(trig_ent, pos, 0).cummax(dim=1).values
+    if input_pos is not None:
+        start = torch.maximum(start, pos - input_pos)
+    pos_mod = (pos - start) % patch_size == 0
+    trig = trig_ent | pos_mod
+
+    # Position 0 always triggers, so subtracting it makes patch ids start at 0.
+    patch_ids = trig.long().cumsum(dim=1) - trig[:, :1].long()
+    return patch_ids
+
+def patch_reduce(h, patch_ids, num_patches, reduce_op="mean"):
     """
     Arguments:
         h: [batch_size, seq_len, emb_dim]
         patch_ids: [batch_size, seq_len]
+        num_patches: int number of output patches, at least patch_ids.max() + 1.
+            Passed in by the caller so we don't need a device sync to find it.
         reduce_op: e.g. "mean", "amin", "amax"
 
     returns: [batch_size, num_patches, emb_dim]
 
     Uses per-example patch counts to avoid batch-dependent behavior.
     Each example's real patches are scatter-reduced independently;
-    shorter examples are zero-padded to the batch max.
+    shorter examples (and any slack in num_patches) are zero-padded.
     """
     batch_size, seq_len, emb_dim = h.shape
 
-    # Per-example patch counts, then pad to batch max
+    # Per-example patch counts, used for the validity mask
     per_example_max = patch_ids.amax(dim=1)  # [batch_size]
-    num_patches = per_example_max.max().item() + 1
 
     # expand dims so we can scatter:
     expanded_ids = patch_ids.unsqueeze(-1).expand(-1, -1, emb_dim)
-    reduced = torch.zeros(batch_size, num_patches, emb_dim, device=h.device, dtype=h.dtype)
-    reduced = reduced.scatter_reduce(
-        dim=1,
-        index=expanded_ids,
-        src=h,
-        reduce=reduce_op,
-        include_self=False,
-    )
+    if reduce_op == "mean":
+        # Mean as a plain sum / count: scatter_add_ is much faster than the
+        # generic scatter_reduce kernel. Accumulate in fp32 so long patches
+        # don't lose precision in bf16. Empty (padding) patches stay zero.
+        sums = torch.zeros(batch_size, num_patches, emb_dim, device=h.device, dtype=torch.float32)
+        sums.scatter_add_(1, expanded_ids, h.to(torch.float32))
+        counts = torch.zeros(batch_size, num_patches, 1, device=h.device, dtype=torch.float32)
+        counts.scatter_add_(1, patch_ids.unsqueeze(-1), torch.ones_like(patch_ids.unsqueeze(-1), dtype=torch.float32))
+        reduced = (sums / counts.clamp_min_(1)).to(h.dtype)
+    else:
+        reduced = torch.zeros(batch_size, num_patches, emb_dim, device=h.device, dtype=h.dtype)
+        reduced = reduced.scatter_reduce(
+            dim=1,
+            index=expanded_ids,
+            src=h,
+            reduce=reduce_op,
+            include_self=False,
+        )
 
     # Build a mask indicating which patches are real vs zero-padded
     # Shape: [batch_size, num_patches] — True for valid patches
@@ -523,20 +630,43 @@ def patch_reduce(h, patch_ids, reduce_op="mean"):
 
     return reduced, patch_mask
 
-def fixed_patch(bytes_tensor: torch.Tensor, patch_size: int = 8):
+def fixed_patch(
+    bytes_tensor: torch.Tensor,
+    patch_size: int = 8,
+    input_pos: Optional[torch.Tensor] = None,
+):
     """Simple fixed-size patching — deterministic, batch-independent.
 
     Args:
         bytes_tensor: [batch_size, seq_len]
         patch_size: number of bytes per patch
+        input_pos: optional [batch_size, seq_len] position of each byte within its
+            packed document. The patch grid restarts at every document.
 
     Returns:
         patch_ids: [batch_size, seq_len] with patch ID for each byte
     """
     batch_size, seq_len = bytes_tensor.shape
+    if input_pos is not None:
+        patch_starts = input_pos % patch_size == 0
+        return patch_starts.long().cumsum(dim=1) - 1
     patch_ids = torch.arange(seq_len, device=bytes_tensor.device) // patch_size
     return patch_ids.unsqueeze(0).expand(batch_size, -1)
 
+def split_patches_at_documents(patch_ids: torch.Tensor, input_pos: torch.Tensor):
+    """Force a patch boundary at the start of every packed document.
+
+    Args:
+        patch_ids: [batch_size, seq_len] non-decreasing patch IDs
+        input_pos: [batch_size, seq_len] position of each byte within its document
+
+    Returns:
+        patch_ids: [batch_size, seq_len] renumbered so no patch spans two documents
+    """
+    patch_starts = input_pos == 0
+    patch_starts[:, 1:] |= patch_ids[:, 1:] != patch_ids[:, :-1]
+    return patch_starts.long().cumsum(dim=1) - 1
+
 
 def compute_patch_size(so_far: torch.Tensor, threshold=3.0, max_patch=8):
     """
@@ -674,11 +804,16 @@ class ByteLatentQwen2p5Decoder(TransformerDecoder):
 
         self.patch_size = patch_size
         self.patching_threshold = patching_threshold
+        # Shared position ids for fixed patching and the patch-level causal
+        # mask, so the hot path doesn't allocate a fresh arange every step.
+        self.register_buffer(
+            '_pos_arange', torch.arange(local_encoder_cfg['max_seq_len']), persistent=False
+        )
         self.freeze_global_for_n_steps = freeze_global_for_n_steps
         self.current_step = 0
         self.global_frozen = freeze_global_for_n_steps > 0
-        if self.global_frozen:
-            self._update_freezing()
+        self._frozen_applied = False  # freezing state last written to requires_grad
+        self._update_freezing()
 
         # Entropy model for dynamic patching (inference only, optional)
         self.entropy_threshold = entropy_threshold
@@ -714,13 +849,45 @@ class ByteLatentQwen2p5Decoder(TransformerDecoder):
                 for p in layer.parameters():
                     nn.init.trunc_normal_(p, mean=0.0, std=std, a=-3*std, b=3*std)
 
+    def _set_global_requires_grad(self, requires_grad: bool):
+        for param in itertools.chain(
+            self.norm.parameters(),
+            self.layers.parameters(),
+            self.output.parameters(),
+            self.tok_embeddings.parameters(),
+        ):
+            param.requires_grad = requires_grad
+
     def _update_freezing(self):
+        # Only walk the parameters when the freezing state actually changes
+        if self._frozen_applied == self.global_frozen:
+            return
+        self._set_global_requires_grad(not self.global_frozen)
+        self._frozen_applied = self.global_frozen
+
+    def on_optimizer_step(self) -> None:
+        """Advance the global freeze schedule. Call once per optimizer step."""
         if self.global_frozen:
-            for param in self.qwen_params:
-                param.requires_grad = False
-        else:
-            for param in self.parameters():
-                param.requires_grad = True
+            self.current_step += 1
+            if self.current_step >= self.freeze_global_for_n_steps:
+                self.global_frozen = False
+                self._update_freezing()
+
+    def unembed(self, h):
+        # Output is Identity: skip the fp32 upcast and chunking, the local
+        # decoder consumes the full hidden state in the model dtype.
+        return self.norm(h)
+
+    def quantize_local_encoder(self) -> None:
+        """Quantize the local encoder's linear weights to int8 for inference.
+
+        The encoder is small and its linears are memory-bound, so int8 weights
+        halve their bandwidth. This is in place and one-way, so eval mode only.
+        """
+        if self.training:
+            raise RuntimeError("quantize_local_encoder is for inference; call model.eval() first")
+        from torchao.quantization import int8_weight_only, quantize_
+        quantize_(self.local_encoder, int8_weight_only())
 
     def set_num_output_chunks(self, num_output_chunks: int) -> None:
         super().set_num_output_chunks(num_output_chunks)
@@ -735,13 +902,16 @@ class ByteLatentQwen2p5Decoder(TransformerDecoder):
         encoder_mask: Optional[torch.Tensor] = None,
         input_pos: Optional[torch.Tensor] = None,
         patch_ids: Optional[torch.Tensor] = None,
+        num_patches: Optional[int] = None,
     ) -> Union[torch.Tensor, List[torch.Tensor]]:
-        # Update freezing state if in training
-        if self.training and self.global_frozen:
-            self.current_step += 1
-            if self.current_step >= self.freeze_global_for_n_steps:
-                self.global_frozen = False
-                self._update_freezing()
+        # Packed batches (e.g. from padded_collate_packed) carry input_pos, the
+        # position of each byte within its own document, and a byte-level block
+        # causal mask. The mask is used as-is by the local encoder/decoder
+        # self-attention; patches are split at document starts and the global
+        # model gets a patch-level block causal mask built below.
+        doc_ids = None
+        if input_pos is not None:
+            doc_ids = (input_pos == 0).long().cumsum(dim=1) - 1
 
         # Three-tier patch_ids resolution:
         # 1. Use provided patch_ids (pre-computed, during training)
@@ -756,33 +926,54 @@ class ByteLatentQwen2p5Decoder(TransformerDecoder):
                     threshold=self.entropy_threshold,
                     max_patch_size=self.max_patch_size,
                 )
+            elif input_pos is None:
+                # Same as fixed_patch(), from the cached positions
+                patch_ids = (self._pos_arange[: tokens.size(1)] // self.patch_size).expand(tokens.size(0), -1)
+                # Fixed patching has exactly ceil(seq_len / patch_size) patches
+                num_patches = math.ceil(tokens.size(1) / self.patch_size)
             else:
-                patch_ids = fixed_patch(tokens, patch_size=self.patch_size)
-    
-        byte_embeds, patch_embs, patch_mask = self.local_encoder(tokens, patch_ids=patch_ids)
+                patch_ids = fixed_patch(tokens, patch_size=self.patch_size, input_pos=input_pos)
+        if input_pos is not None:
+            patch_ids = split_patches_at_documents(patch_ids, input_pos)
+            num_patches = None
+
+        # Dynamic patch_ids are non-decreasing per row, so the last column holds
+        # the max. Only sync for it when the caller didn't tell us the count.
+        if num_patches is None:
+            num_patches = patch_ids[:, -1].max().item() + 1
+
+        # Byte sequences are long, so keep the local encoder and the global model
+        # on the fused O(N)-memory SDPA kernels rather than the math fallback.
+        with sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]):
+            byte_embeds, patch_embs, patch_mask = self.local_encoder(
+                tokens, patch_ids=patch_ids, num_patches=num_patches, mask=mask, input_pos=input_pos
+            )
 
         # Build causal mask for global model that also masks out padding patches.
         # patch_mask: [batch, num_patches] — True for real patches, False for padding.
         # The global model needs [batch, num_patches, num_patches] or compatible shape.
-        if mask is None:
-            num_patches = patch_embs.size(1)
-            # Standard causal mask
-            causal = torch.tril(torch.ones(num_patches, num_patches, device=tokens.device, dtype=torch.bool))
-            # Combine with patch validity: can only attend to valid key patches
-            # patch_mask[:, None, :] broadcasts: [batch, 1, num_patches] — valid keys
-            # patch_mask[:, :, None] broadcasts: [batch, num_patches, 1] — valid queries
-            mask = causal.unsqueeze(0) & patch_mask.unsqueeze(1) & patch_mask.unsqueeze(2)
-
-        global_out = super().forward(patch_embs, mask=mask, input_pos=input_pos)
-
-        # Assuming the outs are chunked, take entry[0] of outputs.
-        if self.num_output_chunks == 0:
-            global_out = global_out.to(torch.bfloat16) # TODO: Another fix for the 0 chunk float. Need to move this dtype definiton.
-            logits = self.local_decoder(byte_embeds, global_out, patch_ids)
-        else:
-            global_out_combined = torch.cat(global_out, dim=1) # Unchunking - it would be better not to pass this through I think.
-            clogits = self.local_decoder(byte_embeds, global_out_combined, patch_ids)
-            logits = [chunk for chunk in clogits.chunk(self.num_output_chunks, dim=1)]
+        # Standard causal mask
+        patch_pos = self._pos_arange[:num_patches]
+        causal = patch_pos.unsqueeze(1) >= patch_pos.unsqueeze(0)
+        # Combine with patch validity: can only attend to valid key patches
+        # patch_mask[:, None, :] broadcasts: [batch, 1, num_patches] — valid keys
+        # patch_mask[:, :, None] broadcasts: [batch, num_patches, 1] — valid queries
+        global_mask = causal.unsqueeze(0) & patch_mask.unsqueeze(1) & patch_mask.unsqueeze(2)
+        patch_doc_ids = None
+        if doc_ids is not None:
+            # Block diagonal over packed documents
+            patch_doc_ids = torch.zeros_like(doc_ids[:, :1]).expand(-1, num_patches).scatter(1, patch_ids, doc_ids)
+            global_mask = global_mask & (patch_doc_ids.unsqueeze(1) == patch_doc_ids.unsqueeze(2))
+
+        # input_pos is byte-level, so it isn't passed on to the patch-level model
+        with sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]):
+            global_out = super().forward(patch_embs, mask=global_mask)
+
+        logits = self.local_decoder(
+            byte_embeds, global_out, patch_ids, mask=mask, patch_doc_ids=patch_doc_ids
+        )
+        if self.num_output_chunks > 0:
+            logits = [chunk for chunk in logits.chunk(self.num_output_chunks, dim=1)]
         return logits
 
     def unified_generate(
@@ -833,7 +1024,9 @@ class ByteLatentQwen2p5Decoder(TransformerDecoder):
         for step_i in range(max_new_tokens):
 
             with torch.no_grad():
-                logits = self.forward(all_tokens, patch_ids=cached_patch_ids)
+                logits = self.forward(
+                    all_tokens, patch_ids=cached_patch_ids, num_patches=current_patch_id + 1
+                )
 
             if isinstance(logits, list):
                 logits = torch.cat(logits, dim=1)
@@ -954,13 +1147,12 @@ class ByteLatentModelTokenizer(nn.Module):
         self.prompt_template = prompt_template
 
     def encode(self, text: str, add_bos: bool = True, add_eos: bool = True) -> List[int]:
-        # naive UTF-8 byte approach:
-        byte_data = list(bytes(text, encoding="utf-8", errors="ignore"))
-        tokens = byte_data
-        if add_bos:
-            tokens = [self.bos_id] + tokens
+        # naive UTF-8 byte approach: extend straight from the bytes object so
+        # the ints are produced in C, with no intermediate lists to concatenate
+        tokens = [self.bos_id] if add_bos else []
+        tokens.extend(text.encode("utf-8", errors="ignore"))
         if add_eos:
-            tokens = tokens + [self.eos_id]
+            tokens.append(self.eos_id)
         return tokens
 
     def decode(self, tokens: List[int]) -> str:
@@ -969,18 +1161,21 @@ class ByteLatentModelTokenizer(nn.Module):
 
 
     def tokenize_messages(self, messages: List[Dict[str, Any]], add_eos: bool = True) -> Tuple[List[int], List[bool]]:
-        tokenized_messages = []
+        # Gather all message bytes into one buffer and convert to ints once
+        # at the end, rather than building a list per message.
+        buf = bytearray()
         mask = []
         for message in messages:
             if message.role != "ipython":
-                role_tokens = self.encode("".join([message.role, "\n"]), add_bos=False, add_eos=False)
-                tokenized_messages.extend(role_tokens)
-                mask.extend([message.masked] * len(role_tokens))
+                role_bytes = "".join([message.role, "\n"]).encode("utf-8", errors="ignore")
+                buf += role_bytes
+                mask.extend([message.masked] * len(role_bytes))
             for item in message.content:
                 if item['type'] == "text":
-                    content_tokens = self.encode(item['content'], add_bos=False, add_eos=False)
-                    tokenized_messages.extend(content_tokens)
-                    mask.extend([message.masked] * len(content_tokens))
+                    content_bytes = item['content'].encode("utf-8", errors="ignore")
+                    buf += content_bytes
+                    mask.extend([message.masked] * len(content_bytes))
+        tokenized_messages = list(buf)
         if add_eos:
             tokenized_messages.append(self.eos_id)
             mask.append(False)
@@ -1136,5 +1331,134 @@ def test_decoder_cross_attention_mask():
     print("PASS: test 2 — shifted mask structure is correct")
 
 
+def test_packed_forward_matches_unpacked():
+    """Validate packed (multi-document) batches against unpacked documents.
+
+    A packed batch carries input_pos (position within each document) and a
+    byte-level block causal mask, as produced by torchtune's PackedDataset.
+    Each document in the pack must give the same logits as running it alone.
+
+    Tests:
+    1. Per-document logits of a padded B=2 pack match each document run alone
+    2. Changing document 1 leaves document 2 untouched, including the first
+       patch of document 2 (whose decoder cross-attn would otherwise see the
+       last patch of document 1)
+
+    Run: python -m ttblt.bltqwen
+    """
+    from torchtune.modules.attention_utils import create_block_causal_mask
+
+    torch.manual_seed(42)
+    patch_size = 4
+    qwen_cfg = dict(
+        embed_dim=64, num_layers=2, num_heads=4, num_kv_heads=2, max_seq_len=64,
+        intermediate_dim=128, attn_dropout=0.0, norm_eps=1e-6,
+    )
+    # Hash n-grams on (the qwen2_5_blt default): they must not span documents
+    local_cfg = dict(
+        embed_dim=64, num_layers=1, num_heads=4, num_kv_heads=4, max_seq_len=64,
+        hidden_dim=128, num_cross_layers=1, use_hash_ngrams=True, num_ngram_buckets=1000,
+    )
+    model = ByteLatentQwen2p5Decoder(
+        qwen_cfg=qwen_cfg,
+        local_encoder_cfg=local_cfg,
+        patch_size=patch_size,
+        decoder_num_layers=2,
+        decoder_num_cross_layers=1,
+    ).to(torch.float32)
+    model.eval()
+
+    # Row 0: two documents (12 + 18 bytes). Row 1: one document + padding,
+    # with input_pos continuing through the padding like PackedDataset.
+    doc_a = torch.randint(0, 256, (12,))
+    doc_b = torch.randint(0, 256, (18,))
+    doc_c = torch.randint(0, 256, (21,))
+    tokens = torch.stack([
+        torch.cat([doc_a, doc_b]),
+        torch.cat([doc_c, torch.full((9,), PAD_ID)]),
+    ])
+    input_pos = torch.stack([
+        torch.cat([torch.arange(12), torch.arange(18)]),
+        torch.arange(30),
+    ])
+    mask = create_block_causal_mask([torch.tensor([12, 18]), torch.tensor([21, 9])])
+
+    # Test 1: each packed document matches the same document run alone
+    with torch.no_grad():
+        packed = model(tokens, mask=mask, input_pos=input_pos)
+        for row, start, doc in [(0, 0, doc_a), (0, 12, doc_b), (1, 0, doc_c)]:
+            alone = model(doc.unsqueeze(0))
+            diff = (packed[row, start:start + len(doc)] - alone[0]).abs().max().item()
+            assert diff < 1e-5, f"Test 1 FAIL: packed doc at row {row}, pos {start} differs (max diff={diff})"
+    print("PASS: test 1 — packed documents match unpacked documents")
+
+    # Test 2: document 1 can't leak into document 2
+    perturbed = tokens.clone()
+    perturbed[0, :12] = torch.randint(0, 256, (12,))
+    with torch.no_grad():
+        packed_perturbed = model(perturbed, mask=mask, input_pos=input_pos)
+    first_patch = slice(12, 12 + patch_size)
+    diff = (packed_perturbed[0, first_patch] - packed[0, first_patch]).abs().max().item()
+    assert diff < 1e-6, f"Test 2 FAIL: first patch of doc 2 sees doc 1 (max diff={diff})"
+    diff = (packed_perturbed[0, 12:] - packed[0, 12:]).abs().max().item()
+    assert diff < 1e-6, f"Test 2 FAIL: doc 2 sees doc 1 (max diff={diff})"
+    print("PASS: test 2 — document 2 does not attend to document 1")
+
+
+def test_local_entropy_backends():
+    """Validate the local entropy backends against each other.
+
+    Tests:
+    1. torch (with and without precomputed freq), numba and triton agree on
+       random bytes and on a single repeated byte with a wide window
+    2. A single repeated byte has zero entropy, alternating bytes reach 1 bit
+
+    numba is skipped when not installed. triton runs on CUDA, or on CPU under
+    TRITON_INTERPRET=1 (read when the kernel is decorated, so set it before
+    importing this module).
+
+    Run: python -m ttblt.bltqwen
+         TRITON_INTERPRET=1 python -m ttblt.bltqwen
+    """
+    torch.manual_seed(42)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    run_triton = HAS_TRITON and (device == "cuda" or os.environ.get("TRITON_INTERPRET") == "1")
+    if not HAS_NUMBA:
+        print("SKIP: numba not installed")
+    if not run_triton:
+        print("SKIP: triton needs CUDA or TRITON_INTERPRET=1")
+
+    # Window 300 pushes counts past uint8 and the entropy table past 256 rows
+    cases = [
+        (torch.randint(0, 256, (3, 40)), 8),
+        (torch.full((2, 320), 65), 300),
+    ]
+
+    # Test 1: all backends agree with the torch reference
+    for tokens, window_size in cases:
+        ref = compute_local_entropy(tokens, window_size=window_size, backend="torch").float()
+        freq = sliding_byte_counts(tokens, window_size=window_size)
+        results = {"torch+freq": compute_local_entropy(tokens, window_size=window_size, freq=freq)}
+        if HAS_NUMBA:
+            results["numba"] = compute_local_entropy(tokens, window_size=window_size, backend="numba")
+        if run_triton:
+            results["triton"] = compute_local_entropy(
+                tokens.to(device), window_size=window_size, backend="triton"
+            ).cpu()
+        for name, out in results.items():
+            diff = (out.float() - ref).abs().max().item()
+            assert diff < 1e-4, f"Test 1 FAIL: {name} differs from torch at window {window_size} (max diff={diff})"
+    print(f"PASS: test 1 — {', '.join(['torch'] + list(results))} backends agree")
+
+    # Test 2: known values
+    ent = compute_local_entropy(torch.full((1, 32), 65), window_size=8, backend="torch")
+    assert ent.abs().max().item() < 1e-6, "Test 2 FAIL: repeated byte should have zero entropy"
+    ent = compute_local_entropy(torch.tensor([[65, 66] * 16]), window_size=7, backend="torch")
+    assert (ent[0, 7:] - 1.0).abs().max().item() < 1e-5, "Test 2 FAIL: alternating bytes should give 1 bit"
+    print("PASS: test 2 — known entropy values are correct")
+
+
 if __name__ == "__main__":
     test_decoder_cross_attention_mask()
+    test_packed_forward_matches_unpacked()
+    test_local_entropy_backends()
@@ -0,0 +1,60 @@
+"""Compiled local entropy kernels for ttblt.bltqwen.compute_local_entropy.
+
+numba and triton are optional and slow to import, so bltqwen only imports
+this module when a caller asks for the "numba" or "triton" backend.
+"""
+
+import numpy as np
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:  # CPU-only installs
+    triton = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from ttblt.bltqwen import VOCAB_SIZE
+
+if triton is not None:
+    @triton.jit
+    def local_entropy_kernel(bytes_ptr, out_ptr, seq_len, window_size, stride_b, BLOCK: tl.constexpr):
+        # One program per batch row. The sliding histogram lives in registers,
+        # so each byte is read from HBM twice (in and out of the window) and
+        # the [seq_len, VOCAB_SIZE] count table is never materialized.
+        row = tl.program_id(0)
+        offs = tl.arange(0, BLOCK)
+        hist = tl.zeros([BLOCK], dtype=tl.float32)
+        row_ptr = bytes_ptr + row * stride_b
+        for pos in range(0, seq_len):
+            cur = tl.load(row_ptr + pos)
+            old = tl.load(row_ptr + pos - window_size - 1, mask=pos > window_size, other=-1)
+            hist += (offs == cur).to(tl.float32) - (offs == old).to(tl.float32)
+            p = hist / tl.minimum(pos + 1, window_size + 1).to(tl.float32)
+            # Empty bins contribute 0 * log2(1) = 0 instead of 0 * -inf = nan
+            ent = tl.sum(-p * tl.log2(tl.where(hist > 0, p, 1.0)), axis=0)
+            tl.store(out_ptr + row * seq_len + pos, ent)
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def local_entropy_numba(byte_ids, window_size, entr_lut):
+        # Rows are independent, so spread them over cores. Each keeps its own
+        # sliding histogram; bin counts and window sizes are small integers,
+        # so -p*log2(p) is looked up as entr_lut[window, count].
+        batch_size, seq_len = byte_ids.shape
+        out = np.empty((batch_size, seq_len), dtype=np.float32)
+        for row in numba.prange(batch_size):
+            hist = np.zeros(VOCAB_SIZE, dtype=np.int32)
+            for pos in range(seq_len):
+                hist[byte_ids[row, pos]] += 1
+                if pos > window_size:
+                    hist[byte_ids[row, pos - window_size - 1]] -= 1
+                denom = min(pos + 1, window_size + 1)
+                ent = 0.0
+                for v in range(VOCAB_SIZE):
+                    ent += entr_lut[denom, hist[v]]
+                out[row, pos] = ent
+        return out